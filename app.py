@@ -1,16 +1,18 @@
 import os
 import json
+import asyncio
+import hashlib
 import logging
-from datetime import datetime, timedelta
+import threading
+import time
 import re
-import requests
-import pytz
-from dateutil import parser as dateparser
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import httpx
+import orjson
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
 
 # -----------------------------
 # Load Environment
@@ -20,6 +22,13 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 BOT_TZ = os.getenv("BOT_TZ", "Asia/Kolkata")
+PUBLIC_URL = os.getenv("PUBLIC_URL")
+PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+if GEMINI_RPM <= 0 or GEMINI_TPM <= 0:
+    raise ValueError("GEMINI_RPM and GEMINI_TPM must be positive")
 GOOGLE_CREDENTIALS = json.loads(os.getenv("GOOGLE_CREDENTIALS"))
 GOOGLE_TOKEN = json.loads(os.getenv("GOOGLE_TOKEN"))
 
@@ -30,6 +39,11 @@ log = logging.getLogger("calbot")
 # Google Calendar Client
 # -----------------------------
 def build_calendar():
+    # Imported here so startup doesn't pay for googleapiclient before the
+    # first calendar action needs it.
+    from googleapiclient.discovery import build
+    from google.oauth2.credentials import Credentials
+
     creds = Credentials(
         token=GOOGLE_TOKEN["access_token"],
         refresh_token=GOOGLE_TOKEN["refresh_token"],
@@ -38,34 +52,78 @@ def build_calendar():
         client_secret=GOOGLE_CREDENTIALS["web"]["client_secret"],
         scopes=["https://www.googleapis.com/auth/calendar"],
     )
-    return build("calendar", "v3", credentials=creds)
+    # The bundled discovery doc is already the default; cache_discovery=False
+    # just skips probing for the unused file cache (and its warning).
+    return build("calendar", "v3", credentials=creds, static_discovery=True, cache_discovery=False)
+
+# httplib2 connections are not thread-safe and calendar calls run on
+# worker threads, so each thread builds its own client on first use.
+_CALENDAR_LOCAL = threading.local()
 
-calendar = build_calendar()
+def get_calendar():
+    calendar = getattr(_CALENDAR_LOCAL, "calendar", None)
+    if calendar is None:
+        calendar = _CALENDAR_LOCAL.calendar = build_calendar()
+    return calendar
 
 # -----------------------------
 # Time Helpers
 # -----------------------------
+# ZoneInfo keeps its own per-key cache, so this is the only construction.
+BOT_TZINFO = ZoneInfo(BOT_TZ)
+
+def _tz(name):
+    return BOT_TZINFO if name == BOT_TZ else ZoneInfo(name)
+
 def now_in_tz(tz_name):
-    return datetime.now(pytz.timezone(tz_name))
+    return datetime.now(_tz(tz_name))
 
-def to_iso(dt):
-    if dt.tzinfo is None:
-        dt = pytz.timezone(BOT_TZ).localize(dt)
-    return dt.isoformat(timespec="seconds")
+def to_iso(dt, default_tz=BOT_TZINFO):
+    if dt.tzinfo:
+        return dt.isoformat(timespec="seconds")
+    return dt.replace(tzinfo=default_tz).isoformat(timespec="seconds")
+
+def iso_now(tz_name):
+    return to_iso(now_in_tz(tz_name))
+
+def parse_iso(s):
+    # Gemini is asked for ISO 8601, so the C fromisoformat handles nearly
+    # everything; dateutil only sees the odd free-form string.
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError:
+        from dateutil import parser as dateparser
+        return dateparser.parse(s)
 
 def ensure_iso_with_tz(s, tz_name):
-    tz = pytz.timezone(tz_name)
-    dt = dateparser.parse(s)
+    dt = parse_iso(s)
     if dt.tzinfo is None:
-        dt = tz.localize(dt)
+        dt = dt.replace(tzinfo=_tz(tz_name))
     return to_iso(dt)
 
+_ISO_WITH_OFFSET_RE = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})$")
+
+def to_time_min(s, tz_name):
+    # Calendar's timeMin takes RFC 3339 with an offset as-is; only reparse
+    # strings that aren't already in that shape.
+    if _ISO_WITH_OFFSET_RE.match(s):
+        return s
+    return ensure_iso_with_tz(s, tz_name)
+
 # -----------------------------
 # Gemini Model Config
 # -----------------------------
 GEMINI_MODEL = "gemini-2.5-flash"
 GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
 
+# Shared keep-alive HTTP/2 client so each message reuses a warm TLS
+# connection without blocking the event loop.
+_HTTPX = httpx.AsyncClient(
+    http2=True,
+    timeout=20,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=10),
+)
+
 SYSTEM_INSTRUCTION = """
 You are a deterministic natural language to structured command translator for Google Calendar.
 You MUST always return ONLY a single valid JSON object, never text, explanations, or code fences.
@@ -93,43 +151,168 @@ Rules:
 10. Do not ask questions — make reasonable assumptions.
 """
 
+# -----------------------------
+# Gemini Rate Limiting
+# -----------------------------
+class TokenBucket:
+    """Paces Gemini calls to stay inside per-minute request and token quotas."""
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, est_tokens):
+        est_tokens = min(est_tokens, self.tpm)
+        # Waiters queue on the lock, so a burst drains in arrival order.
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= est_tokens:
+                    self._requests -= 1
+                    self._tokens -= est_tokens
+                    return
+                wait = max(
+                    (1 - self._requests) * 60 / self.rpm,
+                    (est_tokens - self._tokens) * 60 / self.tpm,
+                )
+                await asyncio.sleep(wait)
+
+_GEMINI_BUCKET = TokenBucket(GEMINI_RPM, GEMINI_TPM)
+
+# -----------------------------
+# Fast-path Parsing
+# -----------------------------
+# Plain "list" requests don't need the model. Anything that mentions a date
+# or time still goes to Gemini so it can be resolved, and deletes always do:
+# they are destructive and need Gemini to normalise the event name.
+_LIST_RE = re.compile(
+    r"^(?:(?:list|show)(?:\s+me)?(?:\s+(?:my|all))?\s+(?:upcoming\s+)?(?:events|calendar|schedule|agenda)"
+    r"|(?:list|show)(?:\s+me)?(?:\s+my)?\s+upcoming"
+    r"|what[’']?s\s+(?:coming\s+up|upcoming)"
+    r"|upcoming(?:\s+events)?)[.!?]*$",
+    re.I,
+)
+_DATETIME_HINT_RE = re.compile(
+    r"\d|\b(today|tonight|tomorrow|yesterday|next|last|this|week|weekend|month|year|"
+    r"mon|tue|wed|thu|fri|sat|sun|monday|tuesday|wednesday|thursday|friday|saturday|sunday|"
+    r"morning|afternoon|evening|noon|midnight|am|pm|at|on|from|until|till|since|before|after)\b",
+    re.I,
+)
+
+def fast_parse_command(user_text: str) -> dict | None:
+    if _DATETIME_HINT_RE.search(user_text):
+        return None
+    if _LIST_RE.match(user_text):
+        return {"intent": "list"}
+    return None
+
+# -----------------------------
+# Gemini Parse Cache
+# -----------------------------
+# Generation is deterministic (temperature 0, one candidate), so the same
+# request in the same timezone within the same 10-minute window gets the
+# same answer.
+PARSE_CACHE_TTL = 600
+PARSE_CACHE_MAX = 1024
+_INSTRUCTION_HASH = hashlib.sha256(SYSTEM_INSTRUCTION.encode()).hexdigest()
+_PARSE_CACHE = {}
+
+def _parse_cache_key(user_text, tz_name, now_local):
+    bucket = now_local.strftime("%Y%m%d%H%M")[:-1]
+    raw = f"{user_text}|{tz_name}|{bucket}|{_INSTRUCTION_HASH}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _parse_cache_get(key):
+    hit = _PARSE_CACHE.get(key)
+    if hit is None:
+        return None
+    expires, parsed = hit
+    if expires < time.monotonic():
+        del _PARSE_CACHE[key]
+        return None
+    return dict(parsed)
+
+def _parse_cache_put(key, parsed):
+    if len(_PARSE_CACHE) >= PARSE_CACHE_MAX:
+        # dicts keep insertion order, so the first key is the oldest
+        del _PARSE_CACHE[next(iter(_PARSE_CACHE))]
+    _PARSE_CACHE[key] = (time.monotonic() + PARSE_CACHE_TTL, dict(parsed))
+
 # -----------------------------
 # Gemini Parsing
 # -----------------------------
-def gemini_parse_command(user_text: str, tz_name: str) -> dict | None:
+# Static part of every generateContent request; only "contents" varies.
+_BASE_BODY = {
+    "systemInstruction": {
+        "role": "system",
+        "parts": [{"text": SYSTEM_INSTRUCTION}]
+    },
+    "generationConfig": {
+        "temperature": 0,
+        "topK": 1,
+        "topP": 0,
+        "candidateCount": 1,
+        "responseMimeType": "application/json"
+    },
+}
+
+# _BASE_BODY serialized once, left open so each call only has to encode
+# its prompt string and close the "contents" array.
+_BODY_PREFIX = orjson.dumps(_BASE_BODY)[:-1] + b',"contents":[{"role":"user","parts":[{"text":'
+_BODY_SUFFIX = b'}]}]}'
+
+_DECODER = json.JSONDecoder()
+
+def _extract_json(text):
+    # responseMimeType is application/json, so the reply is normally a clean
+    # object; otherwise (wrapped in an array, surrounded by prose) decode the
+    # first object starting at the first brace.
+    try:
+        obj = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        obj = None
+    if isinstance(obj, dict):
+        return obj
+    i = text.find("{")
+    if i < 0:
+        return None
+    obj, _ = _DECODER.raw_decode(text, i)
+    return obj if isinstance(obj, dict) else None
+
+async def gemini_parse_command(user_text: str, tz_name: str) -> dict | None:
     now_local = now_in_tz(tz_name)
     now_iso = to_iso(now_local)
 
-    body = {
-        "systemInstruction": {
-            "role": "system",
-            "parts": [{"text": SYSTEM_INSTRUCTION}]
-        },
-        "generationConfig": {
-            "temperature": 0,
-            "topK": 1,
-            "topP": 0,
-            "candidateCount": 1,
-            "responseMimeType": "application/json"
-        },
-        "contents": [
-            {
-                "role": "user",
-                "parts": [{
-                    "text": (
-                        f"NOW_TZ: {tz_name}\n"
-                        f"NOW_ISO: {now_iso}\n"
-                        f"User request: {user_text}"
-                    )
-                }]
-            }
-        ]
-    }
+    cache_key = _parse_cache_key(user_text, tz_name, now_local)
+    cached = _parse_cache_get(cache_key)
+    if cached is not None:
+        log.info("Gemini cache hit")
+        return cached
+
+    prompt = f"NOW_TZ: {tz_name}\nNOW_ISO: {now_iso}\nUser request: {user_text}"
+    body = _BODY_PREFIX + orjson.dumps(prompt) + _BODY_SUFFIX
 
     try:
-        r = requests.post(GEMINI_URL, json=body, timeout=20)
+        # Rough estimate: ~4 chars per token plus the fixed system prompt.
+        await _GEMINI_BUCKET.acquire(len(user_text) // 4 + 500)
+        r = await _HTTPX.post(
+            GEMINI_URL,
+            content=body,
+            headers={"Content-Type": "application/json"},
+        )
         r.raise_for_status()
-        payload = r.json()
+        payload = orjson.loads(r.content)
         log.info("Gemini raw: %s", payload)
 
         text = None
@@ -142,12 +325,11 @@ def gemini_parse_command(user_text: str, tz_name: str) -> dict | None:
         if not text:
             return None
 
-        text = text.strip()
-        m = re.search(r"\{.*\}", text, flags=re.DOTALL)
-        if m:
-            text = m.group(0)
-
-        return json.loads(text)
+        parsed = _extract_json(text)
+        if not isinstance(parsed, dict):
+            return None
+        _parse_cache_put(cache_key, parsed)
+        return parsed
     except Exception as e:
         log.error("Gemini parse error: %s", e)
         return None
@@ -160,17 +342,17 @@ def cal_create(summary, start_iso, end_iso, tz_name):
         "start": {"dateTime": start_iso, "timeZone": tz_name},
         "end": {"dateTime": end_iso, "timeZone": tz_name},
     }
-    ins = calendar.events().insert(calendarId="primary", body=event).execute()
+    ins = get_calendar().events().insert(calendarId="primary", body=event).execute()
     return f"✅ Created: {summary} ({start_iso} → {end_iso})"
 
 def cal_list(starting_from_iso, max_results, tz_name):
     if not starting_from_iso:
-        starting_from_iso = to_iso(now_in_tz(tz_name))
+        starting_from_iso = iso_now(tz_name)
     if not max_results:
         max_results = 5
-    resp = calendar.events().list(
+    resp = get_calendar().events().list(
         calendarId="primary",
-        timeMin=dateparser.parse(starting_from_iso).isoformat(),
+        timeMin=to_time_min(starting_from_iso, tz_name),
         maxResults=max_results,
         singleEvents=True,
         orderBy="startTime",
@@ -178,15 +360,36 @@ def cal_list(starting_from_iso, max_results, tz_name):
     items = resp.get("items", [])
     if not items:
         return "No upcoming events found."
-    return "📅 " + "\n".join(f"• {i['summary']} — {i['start'].get('dateTime', i['start'].get('date'))}" for i in items)
+    lines = [f"• {ev['summary']} — {(start := ev['start']).get('dateTime') or start.get('date')}" for ev in items]
+    return "📅 " + "\n".join(lines)
+
+def delete_events(event_ids):
+    # A single delete goes out directly; several share one batch round trip.
+    calendar = get_calendar()
+    if len(event_ids) == 1:
+        calendar.events().delete(calendarId="primary", eventId=event_ids[0]).execute()
+        return
+    # Batched requests report failures only through the callback, so collect
+    # them and raise rather than letting a failed delete look like success.
+    errors = []
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            errors.append(exception)
+
+    batch = calendar.new_batch_http_request(callback=collect)
+    for event_id in event_ids:
+        batch.add(calendar.events().delete(calendarId="primary", eventId=event_id))
+    batch.execute()
+    if errors:
+        raise errors[0]
 
 def cal_delete(summary, ref_start_iso, tz_name):
-    search_from = dateparser.parse(ref_start_iso).isoformat() if ref_start_iso else to_iso(now_in_tz(tz_name))
-    resp = calendar.events().list(calendarId="primary", timeMin=search_from, maxResults=10, singleEvents=True, orderBy="startTime", q=summary).execute()
+    search_from = to_time_min(ref_start_iso, tz_name) if ref_start_iso else iso_now(tz_name)
+    resp = get_calendar().events().list(calendarId="primary", timeMin=search_from, maxResults=10, singleEvents=True, orderBy="startTime", q=summary).execute()
     items = resp.get("items", [])
     if items:
-        event_id = items[0]["id"]
-        calendar.events().delete(calendarId="primary", eventId=event_id).execute()
+        delete_events([items[0]["id"]])
         return f"🗑️ Deleted: {summary}"
     return "Couldn't find an event to delete."
 
@@ -198,7 +401,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_text = (update.message.text or "").strip()
-    parsed = gemini_parse_command(user_text, BOT_TZ)
+    parsed = fast_parse_command(user_text) or await gemini_parse_command(user_text, BOT_TZ)
     if not parsed:
         await update.message.reply_text("Sorry, I couldn't understand that.")
         return
@@ -216,15 +419,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         end_iso = ensure_iso_with_tz(end_iso, BOT_TZ)
 
     if intent == "list":
-        msg = cal_list(starting_from, max_results, BOT_TZ)
+        msg = await asyncio.to_thread(cal_list, starting_from, max_results, BOT_TZ)
     elif intent == "create":
         if not start_iso:
             start_iso = to_iso(now_in_tz(BOT_TZ).replace(hour=9, minute=0))
         if not end_iso:
-            end_iso = to_iso(dateparser.parse(start_iso) + timedelta(hours=1))
-        msg = cal_create(summary, start_iso, end_iso, BOT_TZ)
+            end_iso = to_iso(parse_iso(start_iso) + timedelta(hours=1))
+        msg = await asyncio.to_thread(cal_create, summary, start_iso, end_iso, BOT_TZ)
     elif intent == "delete":
-        msg = cal_delete(summary, start_iso, BOT_TZ)
+        msg = await asyncio.to_thread(cal_delete, summary, start_iso, BOT_TZ)
     else:
         msg = "Sorry, I couldn't process that request."
 
@@ -233,12 +436,37 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------------
 # Main
 # -----------------------------
+async def close_http(app):
+    await _HTTPX.aclose()
+
 def main():
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Gemini is awaited and Calendar calls run on threads, so let PTB run
+    # updates side by side instead of one user at a time.
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .connection_pool_size(64)
+        .pool_timeout(30)
+        .post_shutdown(close_http)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    log.info("Bot started.")
-    app.run_polling()
+    if PUBLIC_URL:
+        # Telegram pushes updates to us; TLS is terminated by the proxy in
+        # front of PUBLIC_URL.
+        log.info("Bot started (webhook on port %d).", PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"{PUBLIC_URL.rstrip('/')}/{TELEGRAM_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        log.info("Bot started.")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()